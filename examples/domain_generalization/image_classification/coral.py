@@ -14,6 +14,7 @@ import torch.nn as nn
 import torch.backends.cudnn as cudnn
 from torch.optim import SGD
 from torch.optim.lr_scheduler import CosineAnnealingLR
+from torch.cuda.amp import GradScaler
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
@@ -32,6 +33,12 @@ def main(args: argparse.Namespace):
     logger = CompleteLogger(args.log, args.phase)
     print(args)
 
+    if args.amp and args.amp_dtype == 'bfloat16' and not hasattr(torch, 'autocast'):
+        raise ValueError('--amp-dtype bfloat16 requires torch>=1.10, but torch {} is installed'.format(
+            torch.__version__))
+    if args.compile and not hasattr(torch, 'compile'):
+        raise ValueError('--compile requires torch>=2.0, but torch {} is installed'.format(torch.__version__))
+
     if args.seed is not None:
         random.seed(args.seed)
         torch.manual_seed(args.seed)
@@ -43,26 +50,42 @@ def main(args: argparse.Namespace):
                       'from checkpoints.')
 
     cudnn.benchmark = True
+    if torch.cuda.is_available():
+        # allow TensorFloat-32 tensor cores for matmul and convolution on Ampere and newer GPUs
+        torch.backends.cuda.matmul.allow_tf32 = True
+        cudnn.allow_tf32 = True
 
     # Data loading code
     train_transform = utils.get_train_transform(args.train_resizing, random_horizontal_flip=True,
-                                                random_color_jitter=True, random_gray_scale=True)
+                                                random_color_jitter=True, random_gray_scale=True,
+                                                on_gpu=args.gpu_augment)
+    if args.gpu_augment:
+        gpu_transform = utils.GPUTrainTransform(random_horizontal_flip=True, random_color_jitter=True,
+                                                random_gray_scale=True)
+    else:
+        gpu_transform = nn.Identity()
     val_transform = utils.get_val_transform(args.val_resizing)
     print("train_transform: ", train_transform)
+    print("gpu_transform: ", gpu_transform)
     print("val_transform: ", val_transform)
 
+    # keep workers alive across epochs and let each of them prefetch more batches, neither works without workers
+    loader_kwargs = dict(num_workers=args.workers, pin_memory=True)
+    if args.workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
     train_dataset, num_classes = utils.get_dataset(dataset_name=args.data, root=args.root, task_list=args.sources,
                                                    split='train', download=True, transform=train_transform,
                                                    seed=args.seed)
     sampler = utils.RandomDomainSampler(train_dataset, args.batch_size, n_domains_per_batch=args.n_domains_per_batch)
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.workers,
-                              sampler=sampler, drop_last=True)
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, sampler=sampler, drop_last=True,
+                              **loader_kwargs)
     val_dataset, _ = utils.get_dataset(dataset_name=args.data, root=args.root, task_list=args.sources, split='val',
                                        download=True, transform=val_transform, seed=args.seed)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, **loader_kwargs)
     test_dataset, _ = utils.get_dataset(dataset_name=args.data, root=args.root, task_list=args.targets, split='test',
                                         download=True, transform=val_transform, seed=args.seed)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, **loader_kwargs)
     print("train_dataset_size: ", len(train_dataset))
     print('val_dataset_size: ', len(val_dataset))
     print("test_dataset_size: ", len(test_dataset))
@@ -74,6 +97,10 @@ def main(args: argparse.Namespace):
     pool_layer = nn.Identity() if args.no_pool else None
     classifier = utils.ImageClassifier(backbone, num_classes, freeze_bn=args.freeze_bn, dropout_p=args.dropout_p,
                                        finetune=args.finetune, pool_layer=pool_layer).to(device)
+    # NHWC layout lets cuDNN use tensor core kernels without internal transposes
+    classifier = classifier.to(memory_format=torch.channels_last)
+    # compiled module shares parameters with classifier, which is still used for checkpoints and evaluation
+    train_model = torch.compile(classifier, mode='max-autotune') if args.compile else classifier
 
     # define optimizer and lr scheduler
     optimizer = SGD(classifier.get_parameters(base_lr=args.lr), args.lr, momentum=args.momentum, weight_decay=args.wd,
@@ -83,6 +110,10 @@ def main(args: argparse.Namespace):
     # define loss function
     correlation_alignment_loss = CorrelationAlignmentLoss().to(device)
 
+    amp_dtype = getattr(torch, args.amp_dtype)
+    # loss scaling is only needed for float16, bfloat16 has the same dynamic range as float32
+    scaler = GradScaler(enabled=args.amp and args.amp_dtype == 'float16')
+
     # resume from the best checkpoint
     if args.phase != 'train':
         checkpoint = torch.load(logger.get_checkpoint_path('best'), map_location='cpu')
@@ -105,7 +136,9 @@ def main(args: argparse.Namespace):
         return
 
     if args.phase == 'test':
-        acc1 = utils.validate(test_loader, classifier, args, device)
+        eval_model = utils.fuse_conv_bn_eval(classifier)
+        acc1 = utils.validate(test_loader, eval_model, args, device, memory_format=torch.channels_last,
+                              amp=args.amp, amp_dtype=amp_dtype)
         print(acc1)
         return
 
@@ -114,14 +147,18 @@ def main(args: argparse.Namespace):
     best_test_acc1 = 0.
     for epoch in range(args.epochs):
 
-        print(lr_scheduler.get_lr())
+        print(lr_scheduler.get_last_lr())
         # train for one epoch
-        train(train_iter, classifier, optimizer, lr_scheduler, correlation_alignment_loss, args.n_domains_per_batch,
-              epoch, args)
+        train(train_iter, gpu_transform, train_model, optimizer, lr_scheduler, scaler, correlation_alignment_loss,
+              args.n_domains_per_batch, epoch, args)
+
+        # fold bn into conv for evaluation, the fused copy is stale once classifier is trained again
+        eval_model = utils.fuse_conv_bn_eval(classifier)
 
         # evaluate on validation set
         print("Evaluate on validation set...")
-        acc1 = utils.validate(val_loader, classifier, args, device)
+        acc1 = utils.validate(val_loader, eval_model, args, device, memory_format=torch.channels_last,
+                              amp=args.amp, amp_dtype=amp_dtype)
 
         # remember best acc@1 and save checkpoint
         torch.save(classifier.state_dict(), logger.get_checkpoint_path('latest'))
@@ -131,19 +168,23 @@ def main(args: argparse.Namespace):
 
         # evaluate on test set
         print("Evaluate on test set...")
-        best_test_acc1 = max(best_test_acc1, utils.validate(test_loader, classifier, args, device))
+        test_acc1 = utils.validate(test_loader, eval_model, args, device, memory_format=torch.channels_last,
+                                   amp=args.amp, amp_dtype=amp_dtype)
+        best_test_acc1 = max(best_test_acc1, test_acc1)
 
     # evaluate on test set
     classifier.load_state_dict(torch.load(logger.get_checkpoint_path('best')))
-    acc1 = utils.validate(test_loader, classifier, args, device)
+    eval_model = utils.fuse_conv_bn_eval(classifier)
+    acc1 = utils.validate(test_loader, eval_model, args, device, memory_format=torch.channels_last,
+                          amp=args.amp, amp_dtype=amp_dtype)
     print("test acc on test set = {}".format(acc1))
     print("oracle acc on test set = {}".format(best_test_acc1))
     logger.close()
 
 
-def train(train_iter: ForeverDataIterator, model, optimizer, lr_scheduler: CosineAnnealingLR,
-          correlation_alignment_loss: CorrelationAlignmentLoss, n_domains_per_batch: int, epoch: int,
-          args: argparse.Namespace):
+def train(train_iter: ForeverDataIterator, gpu_transform: nn.Module, model, optimizer,
+          lr_scheduler: CosineAnnealingLR, scaler: GradScaler, correlation_alignment_loss: CorrelationAlignmentLoss,
+          n_domains_per_batch: int, epoch: int, args: argparse.Namespace):
     batch_time = AverageMeter('Time', ':4.2f')
     data_time = AverageMeter('Data', ':3.1f')
     losses = AverageMeter('Loss', ':3.2f')
@@ -156,63 +197,88 @@ def train(train_iter: ForeverDataIterator, model, optimizer, lr_scheduler: Cosin
         [batch_time, data_time, losses, losses_ce, losses_penalty, cls_accs],
         prefix="Epoch: [{}]".format(epoch))
 
+    amp_dtype = getattr(torch, args.amp_dtype)
+
+    # loss, cls loss, penalty loss and cls acc are summed on device, and only copied to host when displayed,
+    # which avoids a synchronization every iteration
+    metric_meters = [losses, losses_ce, losses_penalty, cls_accs]
+    metric_sum = torch.zeros(len(metric_meters), device=device)
+    num_accumulated = 0
+
+    # on GPU, iteration time is measured by CUDA events recorded on the stream, which are only waited for when
+    # displayed. Data loading happens on host, so it is always measured by wall clock time.
+    use_cuda_events = device.type == 'cuda'
+    if use_cuda_events:
+        start_event = torch.cuda.Event(enable_timing=True)
+        end_event = torch.cuda.Event(enable_timing=True)
+        start_event.record()
+    else:
+        start = time.time()
+
     # switch to train mode
     model.train()
 
-    end = time.time()
     for i in range(args.iters_per_epoch):
+        end = time.time()
         x_all, labels_all, _ = next(train_iter)
-        x_all = x_all.to(device)
-        labels_all = labels_all.to(device)
-
-        # compute output
-        y_all, f_all = model(x_all)
-
         # measure data loading time
         data_time.update(time.time() - end)
-
-        # separate into different domains
-        y_all = y_all.chunk(n_domains_per_batch, dim=0)
-        f_all = f_all.chunk(n_domains_per_batch, dim=0)
-        labels_all = labels_all.chunk(n_domains_per_batch, dim=0)
-
-        loss_ce = 0
-        loss_penalty = 0
-        cls_acc = 0
-        for domain_i in range(n_domains_per_batch):
-            # cls loss
-            y_i, labels_i = y_all[domain_i], labels_all[domain_i]
-            loss_ce += F.cross_entropy(y_i, labels_i)
-            # update acc
-            cls_acc += accuracy(y_i, labels_i)[0] / n_domains_per_batch
-            # correlation alignment loss
-            for domain_j in range(domain_i + 1, n_domains_per_batch):
-                f_i = f_all[domain_i]
-                f_j = f_all[domain_j]
-                loss_penalty += correlation_alignment_loss(f_i, f_j)
-
-        # normalize loss
-        loss_ce /= n_domains_per_batch
-        loss_penalty /= n_domains_per_batch * (n_domains_per_batch - 1) / 2
-
-        loss = loss_ce + loss_penalty * args.trade_off
-
-        losses.update(loss.item(), x_all.size(0))
-        losses_ce.update(loss_ce.item(), x_all.size(0))
-        losses_penalty.update(loss_penalty.item(), x_all.size(0))
-        cls_accs.update(cls_acc.item(), x_all.size(0))
+        x_all = x_all.to(device, memory_format=torch.channels_last, non_blocking=True)
+        labels_all = labels_all.to(device, non_blocking=True)
+        x_all = gpu_transform(x_all).contiguous(memory_format=torch.channels_last)
+
+        with utils.amp_autocast(args.amp, amp_dtype):
+            # compute output
+            y_all, f_all = model(x_all)
+
+            # cls loss, every domain holds the same number of samples so this equals the mean of per-domain losses
+            loss_ce = F.cross_entropy(y_all, labels_all)
+
+            # update acc, which equals the mean of per-domain accuracies for the same reason
+            cls_acc = accuracy(y_all, labels_all)[0]
+
+            # correlation alignment loss between every pair of domains, computed in one batch
+            # f_all: (n_domains_per_batch, batch_size_per_domain, d)
+            f_all = f_all.view(n_domains_per_batch, -1, f_all.size(-1))
+            mean = f_all.mean(1, keepdim=True)
+            # covariance of each domain is computed only once and shared by all pairs it appears in
+            cov = correlation_alignment_loss.compute_cov(f_all, mean)
+            # squared differences between every pair of domains, averaged over elements as in
+            # correlation_alignment_loss. This is used instead of torch.pdist, whose backward allocates a
+            # (D - 1, D, d * d) buffer and whose forward takes a square root only for it to be squared again.
+            domain_i, domain_j = torch.triu_indices(n_domains_per_batch, n_domains_per_batch, 1, device=f_all.device)
+            mean_diff = (mean[domain_i] - mean[domain_j]).pow(2).mean(dim=(1, 2))
+            cov_diff = (cov[domain_i] - cov[domain_j]).pow(2).mean(dim=(1, 2))
+            # normalize loss
+            loss_penalty = (mean_diff + cov_diff).mean()
+
+            loss = loss_ce + loss_penalty * args.trade_off
+
+        metric_sum += torch.stack([metric.detach().float() for metric in (loss, loss_ce, loss_penalty, cls_acc)])
+        num_accumulated += 1
 
         # compute gradient and do SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         lr_scheduler.step()
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
         if i % args.print_freq == 0:
+            # measure elapsed time
+            if use_cuda_events:
+                end_event.record()
+                end_event.synchronize()
+                elapsed = start_event.elapsed_time(end_event) / 1000
+                start_event.record()
+            else:
+                elapsed = time.time() - start
+                start = time.time()
+            batch_time.update(elapsed / num_accumulated, num_accumulated)
+            for meter, metric in zip(metric_meters, (metric_sum / num_accumulated).tolist()):
+                meter.update(metric, num_accumulated * x_all.size(0))
+            metric_sum.zero_()
+            num_accumulated = 0
             progress.display(i)
 
 
@@ -230,6 +296,8 @@ if __name__ == '__main__':
                         help='target domain(s)')
     parser.add_argument('--train-resizing', type=str, default='default')
     parser.add_argument('--val-resizing', type=str, default='default')
+    parser.add_argument('--gpu-augment', action='store_true',
+                        help='whether apply random flip, color jitter, gray scale and normalization on GPU')
     # model parameters
     parser.add_argument('-a', '--arch', metavar='ARCH', default='resnet50',
                         choices=utils.get_model_names(),
@@ -254,8 +322,12 @@ if __name__ == '__main__':
                         help='momentum')
     parser.add_argument('--wd', '--weight-decay', default=0.0005, type=float,
                         metavar='W', help='weight decay (default: 5e-4)')
-    parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
-                        help='number of data loading workers (default: 4)')
+    parser.add_argument('--compile', action='store_true', help='whether compile the model with torch.compile')
+    parser.add_argument('--amp', action='store_true', help='whether use automatic mixed precision training')
+    parser.add_argument('--amp-dtype', default='float16', type=str, choices=['float16', 'bfloat16'],
+                        help='data type used by autocast when amp is enabled (default: float16)')
+    parser.add_argument('-j', '--workers', default=8, type=int, metavar='N',
+                        help='number of data loading workers (default: 8)')
     parser.add_argument('--epochs', default=20, type=int, metavar='N',
                         help='number of total epochs to run')
     parser.add_argument('-i', '--iters-per-epoch', default=500, type=int,
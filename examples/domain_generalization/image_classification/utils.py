@@ -2,10 +2,12 @@
 @author: Baixu Chen
 @contact: cbx_99_hasta@outlook.com
 """
+import contextlib
 import copy
 import random
 import sys
 import time
+import warnings
 import timm
 import tqdm
 import torch
@@ -142,7 +144,30 @@ def split_dataset(dataset, n, seed=0):
     return Subset(dataset, subset_1), Subset(dataset, subset_2)
 
 
-def validate(val_loader, model, args, device) -> float:
+@contextlib.contextmanager
+def _null_context():
+    # contextlib.nullcontext is only available in python>=3.7
+    yield
+
+
+def amp_autocast(amp=False, dtype=torch.float16):
+    """
+    Return a context manager that runs CUDA operations in mixed precision of data type `dtype` when `amp` is True,
+    and does nothing otherwise. `torch.autocast` is used when available (torch>=1.10), and `torch.cuda.amp.autocast`,
+    which only supports float16, on older torch.
+    """
+    if not amp:
+        return _null_context()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast('cuda', dtype=dtype)
+    if dtype != torch.float16:
+        raise ValueError('autocast with {} requires torch>=1.10, but torch {} is installed'.format(
+            dtype, torch.__version__))
+    return torch.cuda.amp.autocast()
+
+
+def validate(val_loader, model, args, device, memory_format=torch.preserve_format, amp=False,
+             amp_dtype=torch.float16) -> float:
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
@@ -154,25 +179,44 @@ def validate(val_loader, model, args, device) -> float:
     # switch to evaluate mode
     model.eval()
 
-    with torch.no_grad():
+    # inference_mode is only available in torch>=1.9
+    with getattr(torch, 'inference_mode', torch.no_grad)():
+        # loss and acc@1 are summed on device, and only copied to host when displayed or at the end
+        metric_sum = torch.zeros(2, device=device)
+        num_samples = 0
+        num_batches = 0
         end = time.time()
         for i, (images, target, _) in enumerate(val_loader):
-            images = images.to(device)
-            target = target.to(device)
+            images = images.to(device, memory_format=memory_format, non_blocking=True)
+            target = target.to(device, non_blocking=True)
+
+            # zero-pad the last smaller batch to full size, so that cudnn benchmark does not search convolution
+            # algorithms again for a new input shape. Padded samples are dropped from the output.
+            batch_size = images.size(0)
+            if device.type == 'cuda' and torch.backends.cudnn.benchmark and batch_size < val_loader.batch_size:
+                images = F.pad(images, (0, 0) * (images.dim() - 1) + (0, val_loader.batch_size - batch_size))
 
             # compute output
-            output = model(images)
-            loss = F.cross_entropy(output, target)
+            with amp_autocast(amp, amp_dtype):
+                output = model(images)[:batch_size]
+                loss = F.cross_entropy(output, target)
 
             # measure accuracy and record loss
             acc1 = accuracy(output, target)[0]
-            losses.update(loss.item(), images.size(0))
-            top1.update(acc1.item(), images.size(0))
-
-            # measure elapsed time
-            batch_time.update(time.time() - end)
-            end = time.time()
-
+            metric_sum += torch.stack([loss.float(), acc1]) * batch_size
+            num_samples += batch_size
+            num_batches += 1
+
+            if i % args.print_freq == 0 or i == len(val_loader) - 1:
+                for meter, metric in zip([losses, top1], (metric_sum / num_samples).tolist()):
+                    meter.update(metric, num_samples)
+                metric_sum.zero_()
+                num_samples = 0
+                # measure elapsed time, averaged over the batches since the last update. The .tolist() above waits
+                # for the device, so this covers the actual computation rather than just launching it.
+                batch_time.update((time.time() - end) / num_batches, num_batches)
+                num_batches = 0
+                end = time.time()
             if i % args.print_freq == 0:
                 progress.display(i)
 
@@ -181,8 +225,33 @@ def validate(val_loader, model, args, device) -> float:
     return top1.avg
 
 
+def fuse_conv_bn_eval(model: nn.Module) -> nn.Module:
+    """
+    Return a copy of `model` for inference, where every `BatchNorm2d` is folded into its preceding `Conv2d`. This
+    removes one kernel launch and one pass over the activations per convolution. Folding is only valid in eval mode,
+    thus `model` is switched to eval mode and the returned copy must not be trained. If `model` can not be traced by
+    `torch.fx`, `model` itself is returned.
+    """
+    model.eval()
+    try:
+        from torch.fx.experimental.optimization import fuse
+    except ImportError:
+        warnings.warn('Conv-BN fusion is skipped because it requires torch.fx (torch>=1.8), but torch {} is '
+                      'installed'.format(torch.__version__))
+        return model
+
+    # fusion replaces modules in place, so trace a copy and leave model intact
+    fused_model = copy.deepcopy(model)
+    try:
+        graph_module = torch.fx.symbolic_trace(fused_model)
+    except Exception as e:
+        warnings.warn('Conv-BN fusion is skipped because the model can not be traced: {}'.format(e))
+        return model
+    return fuse(graph_module, inplace=True)
+
+
 def get_train_transform(resizing='default', random_horizontal_flip=True, random_color_jitter=True,
-                        random_gray_scale=True):
+                        random_gray_scale=True, on_gpu=False):
     """
     resizing mode:
         - default: random resized crop with scale factor(0.7, 1.0) and size 224;
@@ -195,6 +264,9 @@ def get_train_transform(resizing='default', random_horizontal_flip=True, random_
             smaller side is 256, then take a random crop of size 224;
         – inc.crop: “inception crop” from (Szegedy et al., 2015);
         – cif.crop: resize the image to 224, zero-pad it by 28 on each side, then take a random crop of size 224.
+
+    If on_gpu is True, only resizing is done here and images are returned as uint8 tensors. The remaining
+    augmentations and normalization should then be applied to mini-batches on GPU by `GPUTrainTransform`.
     """
     if resizing == 'default':
         transform = T.RandomResizedCrop(224, scale=(0.7, 1.0))
@@ -229,6 +301,8 @@ def get_train_transform(resizing='default', random_horizontal_flip=True, random_
         ])
     else:
         raise NotImplementedError(resizing)
+    if on_gpu:
+        return T.Compose([transform, T.PILToTensor()])
     transforms = [transform]
     if random_horizontal_flip:
         transforms.append(T.RandomHorizontalFlip())
@@ -243,6 +317,134 @@ def get_train_transform(resizing='default', random_horizontal_flip=True, random_
     return T.Compose(transforms)
 
 
+def _rgb_to_grayscale(x: torch.Tensor) -> torch.Tensor:
+    r, g, b = x.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def _blend(x: torch.Tensor, other: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+    return (factor * x + (1. - factor) * other).clamp(0., 1.)
+
+
+def _adjust_brightness(x: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+    return _blend(x, torch.zeros_like(x), factor)
+
+
+def _adjust_contrast(x: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+    return _blend(x, _rgb_to_grayscale(x).mean(dim=(-3, -2, -1), keepdim=True), factor)
+
+
+def _adjust_saturation(x: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+    return _blend(x, _rgb_to_grayscale(x), factor)
+
+
+def _adjust_hue(x: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+    # rgb -> hsv
+    r, g, b = x.unbind(dim=-3)
+    maxc = x.max(dim=-3).values
+    minc = x.min(dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+
+    # shift hue, factor has shape (N, 1, 1, 1)
+    h = (h + factor.squeeze(dim=-3)) % 1.0
+
+    # hsv -> rgb
+    v = maxc
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(dtype=torch.int32) % 6
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+    mask = (i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)).to(dtype=x.dtype)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask, torch.stack((a1, a2, a3), dim=-4))
+
+
+class GPUTrainTransform(nn.Module):
+    """The GPU counterpart of `get_train_transform` (when on_gpu is True), which takes a mini-batch of uint8 images
+    that are already on GPU, applies random horizontal flip, color jitter and gray scale, and then normalizes them.
+    Every image draws its own random parameters, just like the CPU transforms do, and all images are processed with
+    batched tensor operations.
+
+    Color jitter follows `torchvision.transforms.ColorJitter`: each image adjusts brightness, contrast, saturation
+    and hue in its own random order. At each of the 4 steps, images are grouped by the adjustment they draw, and each
+    adjustment runs once on its group, so every image is adjusted exactly 4 times. The group sizes are copied to host
+    once per mini-batch.
+
+    Args:
+        random_horizontal_flip (bool, optional): whether to apply random horizontal flip. Default: True
+        random_color_jitter (bool, optional): whether to apply random color jitter. Default: True
+        random_gray_scale (bool, optional): whether to apply random gray scale. Default: True
+
+    Shape:
+        - Inputs: :math:`(N, 3, H, W)` with dtype uint8
+        - Outputs: :math:`(N, 3, H, W)` with dtype float32
+    """
+
+    def __init__(self, random_horizontal_flip=True, random_color_jitter=True, random_gray_scale=True):
+        super(GPUTrainTransform, self).__init__()
+        self.random_horizontal_flip = random_horizontal_flip
+        self.random_color_jitter = random_color_jitter
+        self.random_gray_scale = random_gray_scale
+        # same parameters as the CPU transforms
+        self.flip_p = 0.5
+        self.brightness = self.contrast = self.saturation = (0.7, 1.3)
+        self.hue = (-0.3, 0.3)
+        self.gray_scale_p = 0.1
+        self.normalize = T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.float().div_(255.)
+        n = x.size(0)
+        if self.random_horizontal_flip:
+            flip = torch.rand(n, 1, 1, 1, device=x.device) < self.flip_p
+            x = torch.where(flip, x.flip(-1), x)
+        if self.random_color_jitter:
+            x = self.color_jitter(x)
+        if self.random_gray_scale:
+            gray_scale = torch.rand(n, 1, 1, 1, device=x.device) < self.gray_scale_p
+            x = torch.where(gray_scale, _rgb_to_grayscale(x).expand_as(x), x)
+        return self.normalize(x)
+
+    def color_jitter(self, x: torch.Tensor) -> torch.Tensor:
+        n = x.size(0)
+        adjustments = [_adjust_brightness, _adjust_contrast, _adjust_saturation, _adjust_hue]
+        factors = [torch.empty(n, 1, 1, 1, device=x.device).uniform_(*factor_range)
+                   for factor_range in (self.brightness, self.contrast, self.saturation, self.hue)]
+        # a random permutation of the 4 adjustments for every image
+        order = torch.rand(n, len(adjustments), device=x.device).argsort(dim=1)
+        # number of images that pick each adjustment at each step, copied to host once for all steps
+        counts = F.one_hot(order, len(adjustments)).sum(dim=0).tolist()
+        for step in range(len(adjustments)):
+            # group images by the adjustment they pick at this step, so every image is adjusted exactly once
+            perm = order[:, step].argsort()
+            groups = x[perm].split(counts[step])
+            factor_groups = [factor[perm].split(counts[step]) for factor in factors]
+            adjusted = [adjust(group, factor_group[idx]) if group.size(0) > 0 else group
+                        for idx, (adjust, group, factor_group) in enumerate(zip(adjustments, groups, factor_groups))]
+            x = torch.empty_like(x)
+            x[perm] = torch.cat(adjusted)
+        return x
+
+    def extra_repr(self) -> str:
+        return 'random_horizontal_flip={}, random_color_jitter={}, random_gray_scale={}'.format(
+            self.random_horizontal_flip, self.random_color_jitter, self.random_gray_scale)
+
+
 def get_val_transform(resizing='default'):
     """
     resizing mode:
@@ -2,6 +2,7 @@
 @author: Baixu Chen
 @contact: cbx_99_hasta@outlook.com
 """
+from typing import Optional
 import torch
 import torch.nn as nn
 
@@ -37,13 +38,29 @@ class CorrelationAlignmentLoss(nn.Module):
     def __init__(self):
         super(CorrelationAlignmentLoss, self).__init__()
 
+    @staticmethod
+    def compute_cov(f: torch.Tensor, mean: Optional[torch.Tensor] = None) -> torch.Tensor:
+        r"""Compute the covariance matrix :math:`C` of features :math:`f`.
+
+        Args:
+            f (tensor): feature representations
+            mean (tensor, optional): mean of `f` over samples, computed from `f` if not given. Default: None
+
+        Shape:
+            - f: :math:`(*, N, d)` where :math:`*` means any number of leading batch dimensions, e.g. one per domain.
+            - mean: :math:`(*, 1, d)`.
+            - Outputs: :math:`(*, d, d)`.
+        """
+        if mean is None:
+            mean = f.mean(-2, keepdim=True)
+        cent = f - mean
+        return torch.matmul(cent.transpose(-1, -2), cent) / (f.size(-2) - 1)
+
     def forward(self, f_s: torch.Tensor, f_t: torch.Tensor) -> torch.Tensor:
         mean_s = f_s.mean(0, keepdim=True)
         mean_t = f_t.mean(0, keepdim=True)
-        cent_s = f_s - mean_s
-        cent_t = f_t - mean_t
-        cov_s = torch.mm(cent_s.t(), cent_s) / (len(f_s) - 1)
-        cov_t = torch.mm(cent_t.t(), cent_t) / (len(f_t) - 1)
+        cov_s = self.compute_cov(f_s, mean_s)
+        cov_t = self.compute_cov(f_t, mean_t)
 
         mean_diff = (mean_s - mean_t).pow(2).mean()
         cov_diff = (cov_s - cov_t).pow(2).mean()
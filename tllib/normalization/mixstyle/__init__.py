@@ -39,7 +39,7 @@ class MixStyle(nn.Module):
         self.alpha = alpha
 
     def forward(self, x):
-        if not self.training:
+        if not self.training or self.p == 0:
             return x
 
         if random.random() > self.p:
@@ -8,6 +8,10 @@ from tllib.vision.models.resnet import ResNet, load_state_dict_from_url, model_u
 
 __all__ = ['resnet18', 'resnet34', 'resnet50', 'resnet101']
 
+# imagenet pre-trained state dicts that have been loaded, indexed by arch. Building a model copies the parameters
+# into its own tensors, so cached state dicts are never modified and can be reused by later models.
+_PRETRAINED_CACHE = {}
+
 
 def _resnet_with_mix_style(arch, block, layers, pretrained, progress, mix_layers=None, mix_p=0.5, mix_alpha=0.1,
                            resnet_class=ResNet, **kwargs):
@@ -35,30 +39,41 @@ def _resnet_with_mix_style(arch, block, layers, pretrained, progress, mix_layers
     available_resnet_class = [ResNet, ReidResNet]
     assert resnet_class in available_resnet_class
 
+    # resnet_class is fixed once the class is defined, so choose the stem here instead of checking it every forward
+    if resnet_class is ReidResNet:
+        # turn off relu activation for reid tasks
+        def _forward_stem(self, x):
+            return self.maxpool(self.bn1(self.conv1(x)))
+    else:
+        def _forward_stem(self, x):
+            return self.maxpool(self.relu(self.bn1(self.conv1(x))))
+
     class ResNetWithMixStyleModule(resnet_class):
+        forward_stem = _forward_stem
+
         def __init__(self, mix_layers, mix_p=0.5, mix_alpha=0.1, *args, **kwargs):
             super(ResNetWithMixStyleModule, self).__init__(*args, **kwargs)
             self.mixStyleModule = MixStyle(p=mix_p, alpha=mix_alpha)
             for layer in mix_layers:
                 assert layer in ['layer1', 'layer2', 'layer3']
             self.apply_layers = mix_layers
+            # resolve the membership tests once instead of on every forward
+            self._apply1 = 'layer1' in mix_layers
+            self._apply2 = 'layer2' in mix_layers
+            self._apply3 = 'layer3' in mix_layers
 
         def forward(self, x):
-            x = self.conv1(x)
-            x = self.bn1(x)
-            # turn on relu activation here **except for** reid tasks
-            if resnet_class != ReidResNet:
-                x = self.relu(x)
-            x = self.maxpool(x)
+            x = self.forward_stem(x)
 
             x = self.layer1(x)
-            if 'layer1' in self.apply_layers:
+            # MixStyle is an identity in eval mode, so it is skipped entirely to keep the eval graph straight-line
+            if self.training and self._apply1:
                 x = self.mixStyleModule(x)
             x = self.layer2(x)
-            if 'layer2' in self.apply_layers:
+            if self.training and self._apply2:
                 x = self.mixStyleModule(x)
             x = self.layer3(x)
-            if 'layer3' in self.apply_layers:
+            if self.training and self._apply3:
                 x = self.mixStyleModule(x)
             x = self.layer4(x)
 
@@ -68,10 +83,11 @@ def _resnet_with_mix_style(arch, block, layers, pretrained, progress, mix_layers
                                      layers=layers, **kwargs)
     if pretrained:
         model_dict = model.state_dict()
-        pretrained_dict = load_state_dict_from_url(model_urls[arch],
-                                                   progress=progress)
+        if arch not in _PRETRAINED_CACHE:
+            _PRETRAINED_CACHE[arch] = load_state_dict_from_url(model_urls[arch], progress=progress)
+        pretrained_dict = _PRETRAINED_CACHE[arch]
         # remove keys from pretrained dict that doesn't appear in model dict
-        pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
+        pretrained_dict = {k: pretrained_dict[k] for k in pretrained_dict.keys() & model_dict.keys()}
         model.load_state_dict(pretrained_dict, strict=False)
     return model
 